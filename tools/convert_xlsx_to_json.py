@@ -1,11 +1,23 @@
+import argparse
+import csv
 import json
+import os
 import re
+from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
+from itertools import repeat
 
 import pandas as pd
 
+from xlsx_common import detect_map, read_first_sheet_mapped, vector_norm
+
+try:
+    import orjson  # optional: much faster JSON writer
+except ImportError:
+    orjson = None
+
 # =========================
 # CONFIG
 # =========================
@@ -15,20 +27,21 @@ OUTPUT_DIR = str(BASE / "src" / "data")    # JSON outputs go here
 
 WRITE_FULL_JSON = True
 INCLUDE_VILLAGES_IN_FULL = True
+# Columnar copy of all records for offline analysis (reports/dialects.records.parquet).
+# Off by default; needs pyarrow, and is skipped with a note if it is not installed.
+WRITE_RECORDS_PARQUET = False
+# reports/dialects.duplicates.csv is only a dump of the records until duplicate
+# detection exists; off by default, and an existing file is left untouched.
+WRITE_DUP_PLACEHOLDER = False
 
-# Minimal alias map (tweak once, then forget)
-ALIASES = {
-    "language": ["族語", "語言", "Language"],
-    "dialect": ["方言別", "方言", "Dialect"],
-    "county": ["縣市", "縣", "市", "County"],
-    "township": ["鄉鎮市區", "鄉鎮市", "鄉鎮", "Township"],
-    "village": ["村里", "部落", "Village"],
-}
+# Column aliases are shared with the admin tree script: see xlsx_common.ALIASES
 
 # Optional per-file forced mapping (strongest + fastest)
 # Example:
 # FORCED_MAP = {"原住民16族42方言分佈參考.xlsx": {"language":"族語","dialect":"方言別","county":"縣","township":"鄉鎮市","village":"村里"}}
 FORCED_MAP: Dict[str, Dict[str, str]] = {}
+# columns detect_map must find before the outputs can be built
+DETECT_NEEDED = ("language", "dialect", "county", "township")
 
 # Name normalization is loaded from raw/county_reforms.json at startup.
 # The file documents administrative reforms (升格/合併) and orthographic
@@ -37,20 +50,32 @@ FORCED_MAP: Dict[str, Dict[str, str]] = {}
 REFORMS_FILE = BASE / "raw" / "county_reforms.json"
 
 
-def _load_name_normalization() -> Dict[str, str]:
-    """Build flat {old: new} map from county_reforms.json.
-    Falls back to a minimal built-in table if the file is missing."""
+def _load_reforms() -> Tuple[Dict[str, str], Dict[str, Dict[str, str]]]:
+    """Read county_reforms.json once and build both normalization maps:
+    - flat {old: new} name map from the reforms' mappings
+    - {county: {old_township: new_township}} from township_renames
+    Falls back to a minimal built-in name table (and no township renames)
+    if the file is missing or unreadable."""
     if REFORMS_FILE.exists():
         try:
             data = json.loads(REFORMS_FILE.read_text(encoding="utf-8"))
+
             mapping: Dict[str, str] = {}
             for reform in data.get("reforms", []):
                 for m in reform.get("mappings", []):
                     old, new = m.get("old", ""), m.get("new", "")
                     if old and new:
                         mapping[old] = new
+
+            townships: Dict[str, Dict[str, str]] = {}
+            for county, v in data.get("township_renames", {}).items():
+                if county.startswith("_") or not isinstance(v, dict):
+                    continue
+                townships[county] = {k: val for k, val in v.items() if not k.startswith("_")}
+
             print(f"[INFO] Loaded {len(mapping)} name mappings from {REFORMS_FILE.name}")
-            return mapping
+            print(f"[INFO] Loaded township renames for {len(townships)} county/ies from {REFORMS_FILE.name}")
+            return mapping, townships
         except Exception as e:
             print(f"[WARN] Could not load {REFORMS_FILE}: {e} — using built-in fallback")
 
@@ -66,57 +91,37 @@ def _load_name_normalization() -> Dict[str, str]:
         "桃園縣": "桃園市",
         "高雄縣": "高雄市",
         "台東縣": "臺東縣",
-    }
+    }, {}
 
 
-NAME_NORMALIZATION: Dict[str, str] = _load_name_normalization()
-
-
-def _load_township_normalization() -> Dict[str, Dict[str, str]]:
-    """Build {county: {old_township: new_township}} map from county_reforms.json.
-    Falls back to a minimal built-in table if the file is missing."""
-    if REFORMS_FILE.exists():
-        try:
-            data = json.loads(REFORMS_FILE.read_text(encoding="utf-8"))
-            raw = data.get("township_renames", {})
-            result: Dict[str, Dict[str, str]] = {}
-            for county, v in raw.items():
-                if county.startswith("_") or not isinstance(v, dict):
-                    continue
-                result[county] = {k: val for k, val in v.items() if not k.startswith("_")}
-            print(f"[INFO] Loaded township renames for {len(result)} county/ies from {REFORMS_FILE.name}")
-            return result
-        except Exception as e:
-            print(f"[WARN] Could not load township_renames from {REFORMS_FILE}: {e}")
-    return {}
-
-
-TOWNSHIP_NORMALIZATION: Dict[str, Dict[str, str]] = _load_township_normalization()
+NAME_NORMALIZATION, TOWNSHIP_NORMALIZATION = _load_reforms()
 
 # =========================
 # HELPERS
 # =========================
-def is_blank(x) -> bool:
-    if x is None:
-        return True
-    if isinstance(x, float) and pd.isna(x):
-        return True
-    s = str(x).strip()
-    return s == "" or s.lower() == "nan"
-
-
-def norm_text(x) -> str:
-    if is_blank(x):
-        return ""
-    s = str(x)
-    s = s.replace("\u3000", " ")
-    s = re.sub(r"\s+", " ", s).strip()
-    # normalize brackets
-    s = s.replace("（", "(").replace("）", ")")
-    # normalize separators a bit
-    s = s.replace("；", ";").replace("，", ",")
-    # apply name normalization table
-    return NAME_NORMALIZATION.get(s, s)
+# Patterns used by the per-cell normalizers, compiled once at import.
+_PAT_CJK_SPACE = re.compile(r"([\u4e00-\u9fff])\s+([\u4e00-\u9fff])")
+_PAT_PAREN = re.compile(r"\([^)]*\)")
+_PAT_FW_BRACKET = re.compile(r"\u3010[^\u3011]*\u3011")
+_PAT_SQ_BRACKET = re.compile(r"\[[^\]]*\]")
+_PAT_HANGING = re.compile(r"[(\u3010\[].*$")
+_BRACKET_OPENERS = ("(", "\u3010", "[")
+_OPEN_BRACKETS = frozenset(_BRACKET_OPENERS)
+_CLOSE_BRACKETS = frozenset((")", "\u3011", "]"))
+_VILLAGE_SEPARATORS = frozenset(("\u3001", "\n", ",", "\uff0c", "\uff1b", ";", "/"))
+_VILLAGE_SEP_TRANS = str.maketrans({c: "\n" for c in _VILLAGE_SEPARATORS})
+# capturing variants, used to pull the annotation text out
+_PAT_PAREN_NOTE = re.compile(r"\(([^)]*)\)")
+_PAT_FW_NOTE = re.compile(r"\u3010([^\u3011]*)\u3011")
+
+
+def _vector_clean_name(series: pd.Series) -> pd.Series:
+    """Clean a name column: strip leading/trailing whitespace and internal
+    spaces between CJK characters ('卡那卡那 富語' -> '卡那卡那富語').
+    No other normalization is applied. Blank cells become ""."""
+    s = series.astype("string").str.strip()
+    s = s.str.replace(_PAT_CJK_SPACE, r"\1\2", regex=True)
+    return s.fillna("").astype(object)
 
 
 def split_aware_of_brackets(s: str, separators: List[str]) -> List[str]:
@@ -154,18 +159,6 @@ def split_aware_of_brackets(s: str, separators: List[str]) -> List[str]:
     return res
 
 
-def clean_name(s: str) -> str:
-    """Clean a string by stripping leading/trailing whitespace and internal spaces between CJK characters.
-    This fixes issues like '卡那卡那 富語' -> '卡那卡那富語'.
-    """
-    if not isinstance(s, str):
-        return str(s)
-    s = s.strip()
-    # collapse mid-word spaces (e.g. '卡那卡那 富語')
-    s = re.sub(r'([\u4e00-\u9fff])\s+([\u4e00-\u9fff])', r'\1\2', s)
-    return s
-
-
 def clean_village_name(v: str) -> str:
     """Clean a single village name token.
 
@@ -177,15 +170,20 @@ def clean_village_name(v: str) -> str:
     - Leading/trailing whitespace after stripping
     """
     # collapse mid-word spaces (e.g. '\u5167\u7375 \u6751', '\u5357 \u6c99\u9b6f\u91cc')
-    v = re.sub(r'([\u4e00-\u9fff])\s+([\u4e00-\u9fff])', r'\1\2', v)
+    v = _PAT_CJK_SPACE.sub(r'\1\2', v)
+
+    # most tokens carry no annotation at all; every bracket pass below needs
+    # an opening bracket to match, so skip them when there is none
+    if not any(b in v for b in _BRACKET_OPENERS):
+        return v.strip()
 
     # strip matched parentheticals
-    v = re.sub(r'\([^)]*\)', '', v)
-    v = re.sub(r'\u3010[^\u3011]*\u3011', '', v)
-    v = re.sub(r'\[[^\]]*\]', '', v)
+    v = _PAT_PAREN.sub('', v)
+    v = _PAT_FW_BRACKET.sub('', v)
+    v = _PAT_SQ_BRACKET.sub('', v)
 
     # strip unclosed/hanging notes (anything from first paren/bracket to end)
-    v = re.sub(r'[(\u3010\[].*$', '', v)
+    v = _PAT_HANGING.sub('', v)
 
     return v.strip()
 
@@ -234,14 +232,14 @@ def extract_village_annotations(
 
     for tok in tokens:
         # collapse mid-word CJK spaces first
-        tok = re.sub(r'([\u4e00-\u9fff])\s+([\u4e00-\u9fff])', r'\1\2', tok)
+        tok = _PAT_CJK_SPACE.sub(r'\1\2', tok)
         # extract all parenthetical and bracket content before stripping
-        paren_notes = re.findall(r'\(([^)]*)\)', tok)
-        fw_notes = re.findall(r'\u3010([^\u3011]*)\u3011', tok)
+        paren_notes = _PAT_PAREN_NOTE.findall(tok)
+        fw_notes = _PAT_FW_NOTE.findall(tok)
         all_notes = [n.strip() for n in paren_notes + fw_notes if n.strip()]
         # build clean base name
-        base = re.sub(r'\([^)]*\)', '', tok)
-        base = re.sub(r'\u3010[^\u3011]*\u3011', '', base).strip()
+        base = _PAT_PAREN.sub('', tok)
+        base = _PAT_FW_BRACKET.sub('', base).strip()
         if not base:
             continue
         if is_valid_village(base):
@@ -260,75 +258,76 @@ def extract_village_annotations(
     return village_notes, non_admin
 
 
-def split_multi(s: str) -> List[str]:
-    s = norm_text(s)
-    if not s:
-        return []
+def iter_valid_villages(s: str) -> Iterator[str]:
+    """Yield cleaned 村/里 names from an already-normalized village cell.
 
-    # split by list separators, but ignore those inside parentheses
-    separators = ["\u3001", "\n", ",", "\uff0c", "\uff1b", ";", "/"]
-    parts = split_aware_of_brackets(s, separators)
+    Single walk over the string that fuses split_aware_of_brackets,
+    clean_village_name and is_valid_village: list separators only split
+    outside brackets, and tokens that don't clean to a 村/里 are dropped.
+    Duplicates are yielded as-is.
+    """
+    if not any(b in s for b in _BRACKET_OPENERS):
+        # without an opening bracket every separator splits, so let
+        # translate + split do the scan in C
+        for tok in s.translate(_VILLAGE_SEP_TRANS).split("\n"):
+            v = clean_village_name(tok)
+            if is_valid_village(v):
+                yield v
+        return
 
-    # clean and filter each token
-    cleaned = []
-    seen = set()
-    for p in parts:
-        p = clean_village_name(p)
-        if not is_valid_village(p):
-            continue
-        if p not in seen:
-            seen.add(p)
-            cleaned.append(p)
-    return cleaned
+    depth = 0
+    start = 0
+    for i, char in enumerate(s):
+        if char in _OPEN_BRACKETS:
+            depth += 1
+        elif char in _CLOSE_BRACKETS:
+            depth = max(0, depth - 1)
+        elif depth == 0 and char in _VILLAGE_SEPARATORS:
+            v = clean_village_name(s[start:i])
+            if is_valid_village(v):
+                yield v
+            start = i + 1
 
+    v = clean_village_name(s[start:])
+    if is_valid_village(v):
+        yield v
 
-def iter_xlsx_files(folder: Path) -> List[Path]:
-    files = []
-    for p in folder.rglob("*.xlsx"):
-        if p.name.startswith("~$"):
-            continue
-        files.append(p)
-    return sorted(files)
 
+def json_bytes(obj) -> bytes:
+    """UTF-8, 2-space indented JSON. Uses orjson when installed, which
+    produces the same bytes as json.dumps(ensure_ascii=False, indent=2)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
 
-def read_first_sheet(path: Path) -> Tuple[pd.DataFrame, str]:
-    xls = pd.ExcelFile(path)
-    sheet = xls.sheet_names[0]
-    df = pd.read_excel(path, sheet_name=sheet)
-    df = df.dropna(axis=1, how="all")
-    return df, sheet
 
+def write_atomic(path: Path, data: bytes) -> bool:
+    """Write via a per-process temp file + os.replace, so a crashed or
+    concurrent conversion never leaves a half-written output behind.
 
-def detect_map(df: pd.DataFrame) -> Optional[Dict[str, str]]:
-    colnames = [str(c) for c in df.columns]
-    lower = {c: norm_text(c).lower() for c in colnames}
+    If the file already holds exactly these bytes it is only touched (which
+    keeps outputs_up_to_date working) and False is returned."""
+    if path.exists() and path.stat().st_size == len(data) and path.read_bytes() == data:
+        os.utime(path)
+        return False
 
-    out: Dict[str, str] = {}
-    for key, opts in ALIASES.items():
-        opts_norm = [norm_text(o).lower() for o in opts]
-        found = None
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    return True
 
-        # exact match first
-        for c in colnames:
-            if lower[c] in opts_norm:
-                found = c
-                break
 
-        # substring fallback
-        if not found:
-            for c in colnames:
-                for o in opts_norm:
-                    if o and o in lower[c]:
-                        found = c
-                        break
-                if found:
-                    break
+def write_json(path: Path, obj) -> bool:
+    return write_atomic(path, json_bytes(obj))
 
-        if found:
-            out[key] = found
 
-    needed = {"language", "dialect", "county", "township"}
-    return out if needed.issubset(out.keys()) else None
+def iter_xlsx_files(folder: Path) -> List[Path]:
+    files = []
+    for p in folder.rglob("*.xlsx"):
+        if p.name.startswith("~$"):
+            continue
+        files.append(p)
+    return sorted(files)
 
 
 def forward_fill_merged_cells(df: pd.DataFrame, colmap: Dict[str, str]) -> pd.DataFrame:
@@ -336,10 +335,12 @@ def forward_fill_merged_cells(df: pd.DataFrame, colmap: Dict[str, str]) -> pd.Da
     Excel merged cells often come through as NaN on subsequent rows.
     Forward-fill the important columns based on the detected mapping.
     """
-    for k in ["language", "dialect", "county", "township", "village"]:
-        c = colmap.get(k)
-        if c and c in df.columns:
-            df[c] = df[c].ffill()
+    keys = ["language", "dialect", "county", "township", "village"]
+    cols = [colmap[k] for k in keys if k in colmap and colmap[k] in df.columns]
+    # one multi-column ffill; dedupe in case two keys map to the same column
+    cols = list(dict.fromkeys(cols))
+    if cols:
+        df[cols] = df[cols].ffill()
     return df
 
 
@@ -353,13 +354,18 @@ def df_to_records(df: pd.DataFrame, colmap: Dict[str, str]) -> tuple:
     all_village_notes: Dict[str, str] = {}
     all_non_admin: List[dict] = []
 
-    for _, row in df.iterrows():
-        language = clean_name(row.get(colmap["language"]))
-        dialect = clean_name(row.get(colmap["dialect"]))
-        county_raw = clean_name(row.get(colmap["county"]))
-        township = clean_name(row.get(colmap["township"]))
-        village_raw = norm_text(row.get(colmap.get("village", ""))) if "village" in colmap else ""
+    # normalize the mapped columns up front, into plain arrays, so the row
+    # loop does no text work and no pandas lookups
+    # (names only get whitespace cleanup; county normalization happens below)
+    cols = {}
+    for k, c in colmap.items():
+        s = vector_norm(df[c], NAME_NORMALIZATION) if k == "village" else _vector_clean_name(df[c])
+        cols[k] = s.to_numpy()
+
+    village_col = cols["village"] if "village" in cols else repeat("")
+    rows = zip(cols["language"], cols["dialect"], cols["county"], cols["township"], village_col)
 
+    for language, dialect, county_raw, township, village_raw in rows:
         # skip empty rows
         if not any([language, dialect, county_raw, township, village_raw]):
             continue
@@ -378,7 +384,7 @@ def df_to_records(df: pd.DataFrame, colmap: Dict[str, str]) -> tuple:
             rec["鄉鎮市"] = township
 
         if "village" in colmap:
-            villages = split_multi(village_raw)
+            villages = list(dict.fromkeys(iter_valid_villages(village_raw)))
             if INCLUDE_VILLAGES_IN_FULL:
                 rec["村里"] = villages
             else:
@@ -398,185 +404,135 @@ def df_to_records(df: pd.DataFrame, colmap: Dict[str, str]) -> tuple:
 # =========================
 # BUILDERS (bundle + stats)
 # =========================
-def build_area_index(records: List[dict]) -> Dict:
-    """
-    areaIndex[county][township] = list of {族語, 方言別}
-    de-duplicated, stable insertion order.
-    """
-    idx: Dict[str, Dict[str, List[dict]]] = {}
-    for r in records:
-        c, t = r.get("縣", ""), r.get("鄉鎮市", "")
-        lang, dia = r.get("族語", ""), r.get("方言別", "")
-        if not (c and t and lang and dia):
-            continue
-
-        idx.setdefault(c, {})
-        idx[c].setdefault(t, [])
-
-        entry = {"族語": lang, "方言別": dia}
-        if entry not in idx[c][t]:
-            idx[c][t].append(entry)
-
-    return idx
-
-
-def build_language_groups(area_index: Dict[str, Dict[str, List[dict]]]) -> Dict[str, List[str]]:
-    """
-    languageGroups[族語] = [方言別...]
-    """
-    groups: Dict[str, set] = {}
-    for towns in area_index.values():
-        for entries in towns.values():
-            for e in entries:
-                lang = e.get("族語", "")
-                dia = e.get("方言別", "")
-                if not (lang and dia):
-                    continue
-                groups.setdefault(lang, set()).add(dia)
-
-    return {lang: sorted(list(dias)) for lang, dias in groups.items()}
-
-
-def compute_admin_division_stats_v2(records: List[dict]) -> Dict:
+def build_all(records: List[dict]) -> Dict:
     """
-    For each language and each dialect, count distinct:
-    - counties: unique 縣
-    - townships: unique (縣, 鄉鎮市) pairs
-    - villages: unique (縣, 鄉鎮市, 村里) triples
-
-    Also returns overall totals.
-    Dialect key uses '族語|方言別' to avoid name collisions.
+    Walk records once, updating every aggregator in lockstep. Returns:
+    - area_index: areaIndex[county][township] = list of {族語, 方言別},
+      de-duplicated, stable insertion order
+    - language_groups: see build_language_groups
+    - admin_stats: per language / per dialect / overall counts of distinct
+      counties (縣), townships (縣, 鄉鎮市) and villages (縣, 鄉鎮市, 村里);
+      dialect keys use '族語|方言別'; raises ValueError if two pairs join to the same key
+    - full: records grouped by (族語, 方言別)
+    - village_lookup: {"縣|鄉鎮市|村里": ["方言別", ...]}, used by the
+      village-level map layer to color 里/村 by dialect
+    - admin_tree_md: human-readable markdown tree of the divisions found
     """
+    # (族語, 方言別) pairs per township as dict keys: an insertion-ordered set
+    area: Dict[str, Dict[str, Dict[Tuple[str, str], None]]] = {}
+    grouped: Dict[Tuple[str, str], Dict] = {}
+    # dialects per village as dict keys: O(1) de-duplication, first-seen order
+    lookup: Dict[str, Dict[str, None]] = defaultdict(dict)
+    tree: Dict[str, Dict[str, set]] = {}
 
-    overall_counties = set()
-    overall_townships = set()   # (縣, 鄉鎮市)
-    overall_villages = set()    # (縣, 鄉鎮市, 村里)
-
-    # per language
-    lang_counties: Dict[str, set] = {}
-    lang_townships: Dict[str, set] = {}
-    lang_villages: Dict[str, set] = {}
-
-    # per dialect (lang|dialect)
-    dia_counties: Dict[str, set] = {}
-    dia_townships: Dict[str, set] = {}
-    dia_villages: Dict[str, set] = {}
+    # distinct division sets per scope, see _division_sets
+    overall = _division_sets()
+    lang_stats: Dict[str, Dict[str, set]] = {}
+    dia_stats: Dict[Tuple[str, str], Dict[str, set]] = {}   # keyed by (lang, dialect)
 
     for r in records:
         lang = r.get("族語", "")
         dia = r.get("方言別", "")
         c = r.get("縣", "")
         t = r.get("鄉鎮市", "")
-        if not (lang and dia and c and t):
+        villages = r.get("村里", [])
+        if not isinstance(villages, list):
+            villages = []
+
+        if lang and dia:
+            g = grouped.setdefault((lang, dia), {"族語": lang, "方言別": dia, "分佈": []})
+            dist_item = {"縣": c, "鄉鎮市": t}
+            if "村里" in r:
+                dist_item["村里"] = r["村里"]
+            g["分佈"].append(dist_item)
+
+        if not (c and t):
             continue
 
-        dkey = f"{lang}|{dia}"
+        town_villages = tree.setdefault(c, {}).setdefault(t, set())
+        town_villages.update(v for v in villages if v)
 
-        overall_counties.add(c)
-        overall_townships.add((c, t))
+        if dia:
+            for v in villages:
+                if v:
+                    lookup[f"{c}|{t}|{v}"][dia] = None
 
-        lang_counties.setdefault(lang, set()).add(c)
-        lang_townships.setdefault(lang, set()).add((c, t))
+        if not (lang and dia):
+            continue
 
-        dia_counties.setdefault(dkey, set()).add(c)
-        dia_townships.setdefault(dkey, set()).add((c, t))
+        area.setdefault(c, {}).setdefault(t, {})[(lang, dia)] = None
 
-        villages = r.get("村里", [])
-        if isinstance(villages, list):
-            for v in villages:
-                if not v:
-                    continue
-                overall_villages.add((c, t, v))
-                lang_villages.setdefault(lang, set()).add((c, t, v))
-                dia_villages.setdefault(dkey, set()).add((c, t, v))
-
-    per_language = {
-        lang: {
-            "縣_count": len(lang_counties.get(lang, set())),
-            "鄉鎮市_count": len(lang_townships.get(lang, set())),
-            "村里_count": len(lang_villages.get(lang, set())),
-        }
-        for lang in sorted(set(lang_counties) | set(lang_townships) | set(lang_villages))
+        ls = lang_stats.get(lang)
+        if ls is None:
+            ls = lang_stats[lang] = _division_sets()
+        ds = dia_stats.get((lang, dia))
+        if ds is None:
+            ds = dia_stats[(lang, dia)] = _division_sets()
+
+        triples = [(c, t, v) for v in villages if v]
+        for scope in (overall, ls, ds):
+            scope["縣"].add(c)
+            scope["鄉鎮市"].add((c, t))
+            scope["村里"].update(triples)
+
+    area_index = {
+        c: {t: [{"族語": lang, "方言別": dia} for lang, dia in pairs] for t, pairs in towns.items()}
+        for c, towns in area.items()
     }
 
+    per_language = {lang: _division_counts(ls) for lang, ls in sorted(lang_stats.items())}
+
+    # output keys are '族語|方言別' strings, ordered as strings; two pairs that
+    # join to the same string (a '|' inside a name) cannot both be represented
+    joined: Dict[str, Tuple[str, str]] = {}
+    for pair in dia_stats:
+        dkey = f"{pair[0]}|{pair[1]}"
+        if joined.setdefault(dkey, pair) != pair:
+            raise ValueError(f"dialects {joined[dkey]} and {pair} share the perDialect key '{dkey}'")
     per_dialect = {
-        dkey: {
-            "族語": dkey.split("|", 1)[0],
-            "方言別": dkey.split("|", 1)[1],
-            "縣_count": len(dia_counties.get(dkey, set())),
-            "鄉鎮市_count": len(dia_townships.get(dkey, set())),
-            "村里_count": len(dia_villages.get(dkey, set())),
-        }
-        for dkey in sorted(set(dia_counties) | set(dia_townships) | set(dia_villages))
+        dkey: {"族語": lang, "方言別": dia, **_division_counts(dia_stats[(lang, dia)])}
+        for dkey, (lang, dia) in sorted(joined.items())
     }
 
     return {
-        "overall": {
-            "縣_count": len(overall_counties),
-            "鄉鎮市_count": len(overall_townships),
-            "村里_count": len(overall_villages),
+        "area_index": area_index,
+        "language_groups": build_language_groups(area),
+        "admin_stats": {
+            "overall": _division_counts(overall),
+            "perLanguage": per_language,
+            "perDialect": per_dialect,
         },
-        "perLanguage": per_language,
-        "perDialect": per_dialect,
+        "full": {"schema": "taiwan.dialect.full.v1", "items": list(grouped.values())},
+        "village_lookup": {"schema": "taiwan.village.lookup.v1", "lookup": {k: list(v) for k, v in lookup.items()}},
+        "admin_tree_md": render_admin_tree_md(tree),
     }
 
 
-def build_full_grouped(records: List[dict]) -> Dict:
-    """
-    Optional: group by (族語, 方言別) like your original style.
-    """
-    grouped: Dict[Tuple[str, str], Dict] = {}
-    for r in records:
-        key = (r.get("族語", ""), r.get("方言別", ""))
-        if not all(key):
-            continue
-
-        grouped.setdefault(key, {"族語": key[0], "方言別": key[1], "分佈": []})
+def _division_sets() -> Dict[str, set]:
+    """Distinct counties (縣), townships (縣, 鄉鎮市) and villages (縣, 鄉鎮市, 村里) seen in one stats scope."""
+    return {"縣": set(), "鄉鎮市": set(), "村里": set()}
 
-        dist_item = {"縣": r.get("縣", ""), "鄉鎮市": r.get("鄉鎮市", "")}
-        if "村里" in r:
-            dist_item["村里"] = r["村里"]
 
-        grouped[key]["分佈"].append(dist_item)
+def _division_counts(sets: Dict[str, set]) -> Dict[str, int]:
+    return {f"{k}_count": len(v) for k, v in sets.items()}
 
-    return {"schema": "taiwan.dialect.full.v1", "items": list(grouped.values())}
 
-def build_village_lookup(records: List[dict]) -> Dict:
+def build_language_groups(area: Dict[str, Dict[str, Dict[Tuple[str, str], None]]]) -> Dict[str, List[str]]:
     """
-    Build a flat lookup: {"縣|鄉鎮市|村里": ["方言別", ...]}
-    Used by the future village-level map layer to color 里/村 by dialect.
+    languageGroups[族語] = [方言別...], read straight off the
+    {county: {township: {(族語, 方言別), ...}}} pairs collected by build_all.
     """
-    lookup: Dict[str, List[str]] = {}
-    for r in records:
-        c = r.get("縣", "")
-        t = r.get("鄉鎮市", "")
-        dia = r.get("方言別", "")
-        if not (c and t and dia):
-            continue
-        for v in r.get("村里", []):
-            if not v:
-                continue
-            key = f"{c}|{t}|{v}"
-            if dia not in lookup.get(key, []):
-                lookup.setdefault(key, []).append(dia)
-    return {"schema": "taiwan.village.lookup.v1", "lookup": lookup}
+    groups: Dict[str, set] = {}
+    for towns in area.values():
+        for pairs in towns.values():
+            for lang, dia in pairs:
+                groups.setdefault(lang, set()).add(dia)
 
+    return {lang: sorted(dias) for lang, dias in groups.items()}
 
-def build_admin_tree_md(records: List[dict]) -> str:
-    """Build a human-readable markdown tree of the administrative divisions found in the data."""
-    tree: Dict[str, Dict[str, set]] = {}
-    for r in records:
-        c = r.get("縣", "")
-        t = r.get("鄉鎮市", "")
-        villages = r.get("村里", [])
-        if not (c and t):
-            continue
-        tree.setdefault(c, {}).setdefault(t, set())
-        if isinstance(villages, list):
-            for v in villages:
-                if v:
-                    tree[c][t].add(v)
 
+def render_admin_tree_md(tree: Dict[str, Dict[str, set]]) -> str:
+    """Render {county: {township: {villages}}} as a human-readable markdown tree."""
     lines = ["# Administrative division tree recorded in source\n"]
     counties = sorted(tree.keys())
     lines.append(f"- Counties: **{len(counties)}**\n")
@@ -586,18 +542,17 @@ def build_admin_tree_md(records: List[dict]) -> str:
         lines.append(f"\n## {county}\n")
         lines.append(f"- 鄉鎮市：**{len(towns)}**\n")
         for town in sorted(towns.keys()):
-            villages = sorted(list(towns[town]))
+            villages = sorted(towns[town])
             lines.append(f"- **{town}** (村里：{len(villages)})\n")
             for v in villages:
                 lines.append(f"  - {v}\n")
 
     return "".join(lines)
 
-def build_bundle(xlsx_name: str, sheet: str, area_index: Dict, language_groups: Dict, records: List[dict], colmap: Dict[str, str]) -> Dict:
-    languages = sorted(list(language_groups.keys()))
-    all_dialects = sorted({f"{e['族語']}|{e['方言別']}" for towns in area_index.values() for entries in towns.values() for e in entries})
-
-    admin_stats = compute_admin_division_stats_v2(records)
+def build_bundle(xlsx_name: str, sheet: str, area_index: Dict, language_groups: Dict, admin_stats: Dict, records: List[dict], colmap: Dict[str, str]) -> Dict:
+    languages = sorted(language_groups)
+    # language_groups already holds each (族語, 方言別) pair exactly once
+    all_dialects = sorted(f"{lang}|{dia}" for lang, dias in language_groups.items() for dia in dias)
 
     return {
         "schema": "taiwan.dialect.bundle.v1",
@@ -619,10 +574,37 @@ def build_bundle(xlsx_name: str, sheet: str, area_index: Dict, language_groups:
 # =========================
 # MAIN
 # =========================
-def convert_one(xlsx: Path, out_dir: Path):
-    df, sheet = read_first_sheet(xlsx)
+def output_paths(out_dir: Path) -> List[Path]:
+    """Every file convert_one writes for a workbook whose columns could be mapped."""
+    report_dir = out_dir / "reports"
+    paths = [
+        out_dir / "dialects.bundle.json",
+        out_dir / "dialects.index.json",
+        report_dir / "dialects.summary.md",
+    ]
+    if WRITE_FULL_JSON:
+        paths += [out_dir / "dialects.full.json", out_dir / "villages.lookup.json", out_dir / "villages.notes.json"]
+    if WRITE_RECORDS_PARQUET:
+        paths.append(report_dir / "dialects.records.parquet")
+    if WRITE_DUP_PLACEHOLDER:
+        paths.append(report_dir / "dialects.duplicates.csv")
+    return paths
+
+
+def outputs_up_to_date(sources: List[Path], out_dir: Path) -> bool:
+    """True if every output exists and is at least as new as all the source
+    XLSX files and the reforms file."""
+    src_mtime = max(p.stat().st_mtime for p in sources)
+    if REFORMS_FILE.exists():
+        src_mtime = max(src_mtime, REFORMS_FILE.stat().st_mtime)
+    return all(p.exists() and p.stat().st_mtime >= src_mtime for p in output_paths(out_dir))
 
-    colmap = FORCED_MAP.get(xlsx.name) or detect_map(df)
+
+def convert_one(xlsx: Path, out_dir: Path):
+    # map on the header row, then parse only the mapped columns
+    df, sheet, colmap = read_first_sheet_mapped(
+        xlsx, lambda frame: FORCED_MAP.get(xlsx.name) or detect_map(frame, DETECT_NEEDED, NAME_NORMALIZATION)
+    )
     if not colmap:
         raw = {
             "schema": "xlsx.raw_preview.v1",
@@ -633,19 +615,19 @@ def convert_one(xlsx: Path, out_dir: Path):
             "note": "Could not map required columns to build outputs. Add FORCED_MAP or extend ALIASES.",
         }
         raw_path = out_dir / f"{xlsx.stem}.raw_preview.json"
-        raw_path.write_text(json.dumps(raw, ensure_ascii=False, indent=2), encoding="utf-8")
+        write_json(raw_path, raw)
         print(f"[WARN] wrote: {raw_path.resolve()} (mapping missing)")
         return
 
     df = forward_fill_merged_cells(df, colmap)
     records, village_notes, non_admin = df_to_records(df, colmap)
 
-    area_index = build_area_index(records)
-    language_groups = build_language_groups(area_index)
+    built = build_all(records)
+    area_index = built["area_index"]
 
-    bundle = build_bundle(xlsx.name, sheet, area_index, language_groups, records, colmap)
+    bundle = build_bundle(xlsx.name, sheet, area_index, built["language_groups"], built["admin_stats"], records, colmap)
     bundle_path = out_dir / "dialects.bundle.json"
-    bundle_path.write_text(json.dumps(bundle, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_json(bundle_path, bundle)
     print(f"[OK]  wrote: {bundle_path.resolve()}")
 
     # Output reports to a subfolder
@@ -653,16 +635,16 @@ def convert_one(xlsx: Path, out_dir: Path):
     report_dir.mkdir(exist_ok=True)
 
     if WRITE_FULL_JSON:
-        full = build_full_grouped(records)
+        full = built["full"]
         full_path = out_dir / "dialects.full.json"
-        full_path.write_text(json.dumps(full, ensure_ascii=False, indent=2), encoding="utf-8")
-        print(f"      wrote: {full_path.resolve()}")
+        if write_json(full_path, full):
+            print(f"      wrote: {full_path.resolve()}")
 
-        village_lookup = build_village_lookup(records)
+        village_lookup = built["village_lookup"]
         vl_path = out_dir / "villages.lookup.json"
-        vl_path.write_text(json.dumps(village_lookup, ensure_ascii=False, indent=2), encoding="utf-8")
-        village_count = len(village_lookup["lookup"])
-        print(f"      wrote: {vl_path.resolve()} ({village_count} entries)")
+        if write_json(vl_path, village_lookup):
+            village_count = len(village_lookup["lookup"])
+            print(f"      wrote: {vl_path.resolve()} ({village_count} entries)")
 
         annotations_out = {
             "schema": "taiwan.village.annotations.v1",
@@ -671,21 +653,41 @@ def convert_one(xlsx: Path, out_dir: Path):
             "non_admin_places": non_admin,
         }
         va_path = out_dir / "villages.notes.json"
-        va_path.write_text(json.dumps(annotations_out, ensure_ascii=False, indent=2), encoding="utf-8")
-        print(f"      wrote: {va_path.resolve()} ({len(village_notes)} notes)")
+        if write_json(va_path, annotations_out):
+            print(f"      wrote: {va_path.resolve()} ({len(village_notes)} notes)")
 
     # reports
     tree_path = report_dir / "dialects.summary.md"
-    tree_path.write_text(build_admin_tree_md(records), encoding="utf-8")
+    write_atomic(tree_path, built["admin_tree_md"].encode("utf-8"))
 
     index_path = out_dir / "dialects.index.json" # keep index in main data if it's used by frontend
-    index_path.write_text(json.dumps(area_index, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    dup_path = report_dir / "dialects.duplicates.csv"
-    pd.DataFrame(records).to_csv(dup_path, index=False) # this is a placeholder for duplicate logic if needed later
+    write_json(index_path, area_index)
 
+    if WRITE_RECORDS_PARQUET:
+        parquet_path = report_dir / "dialects.records.parquet"
+        try:
+            # serialized in memory so it goes through write_atomic like the JSON outputs
+            write_atomic(parquet_path, pd.DataFrame(records).to_parquet(compression="zstd", index=False))
+        except ImportError:
+            print(f"[INFO] pyarrow not installed — skipped {parquet_path.name}")
+
+    if WRITE_DUP_PLACEHOLDER:
+        dup_path = report_dir / "dialects.duplicates.csv"
+        # this is a placeholder for duplicate logic if needed later; streams the
+        # records straight out (columns in first-seen order, lists as their repr,
+        # os.linesep line endings), as DataFrame.to_csv wrote them
+        fieldnames = list(dict.fromkeys(k for r in records for k in r))
+        with dup_path.open("w", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=fieldnames, lineterminator=os.linesep)
+            w.writeheader()
+            w.writerows(records)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Convert the raw XLSX into the dialect JSON bundle.")
+    parser.add_argument("--force", action="store_true", help="rebuild even if outputs are newer than the source")
+    args = parser.parse_args(argv)
 
-def main():
     base = Path(INPUT_DIR) if INPUT_DIR else Path(__file__).resolve().parent
     out_base = Path(OUTPUT_DIR) if OUTPUT_DIR else base
     out_base.mkdir(parents=True, exist_ok=True)
@@ -699,6 +701,13 @@ def main():
     for f in files:
         print("  -", f.resolve())
 
+    # the workbooks share one set of outputs, so they are skipped or rebuilt together
+    if files and not args.force and outputs_up_to_date(files, out_base):
+        print("[SKIP] outputs are up to date (use --force to rebuild)")
+        files = []
+
+    # every workbook writes the same output names, so convert serially in
+    # sorted order: the last file wins, consistently
     for xlsx in files:
         try:
             convert_one(xlsx, out_base)
@@ -1,11 +1,16 @@
 import csv
-import re
+import os
+import sys
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Tuple
 
 import pandas as pd
 
+from xlsx_common import detect_map, read_first_sheet, vector_norm
+
 # ---------------- CONFIG ----------------
 BASE = Path(__file__).resolve().parents[1]   # project root (tools/..)
 INPUT_DIR = BASE / "raw"                    # where xlsx lives
@@ -14,13 +19,10 @@ OUTPUT_DIR = BASE / "src" / "data"          # outputs here
 # Set to None to print ALL villages (can be huge).
 MAX_VILLAGES_PER_TOWNSHIP = None  # e.g. 50
 
-ALIASES = {
-    "language": ["族語", "語言", "Language"],
-    "dialect": ["方言別", "方言", "Dialect"],
-    "county": ["縣市", "縣", "市", "County"],
-    "township": ["鄉鎮市區", "鄉鎮市", "鄉鎮", "Township"],
-    "village": ["村里", "部落", "Village"],
-}
+# columns detect_map must find before the tree can be built
+DETECT_NEEDED = ("county", "township", "village")
+
+# Column aliases are shared with the converter: see xlsx_common.ALIASES
 
 NAME_NORMALIZATION = {
     "台北市": "臺北市",
@@ -32,82 +34,31 @@ NAME_NORMALIZATION = {
 # ---------------------------------------
 
 
-def is_blank(x) -> bool:
-    if x is None:
-        return True
-    if isinstance(x, float) and pd.isna(x):
-        return True
-    s = str(x).strip()
-    return s == "" or s.lower() == "nan"
-
+# list separators all mapped to "\n", so a plain str.split does the splitting
+_SEP_TRANS = str.maketrans({c: "\n" for c in ",;/"})
 
-def norm_text(x) -> str:
-    if is_blank(x):
-        return ""
-    s = str(x).replace("\u3000", " ")
-    s = re.sub(r"\s+", " ", s).strip()
-    s = s.replace("（", "(").replace("）", ")")
-    s = s.replace("；", ";").replace("，", ",")
-    s = NAME_NORMALIZATION.get(s, s)
-    return s
 
-
-def split_multi(s: str) -> List[str]:
-    s = norm_text(s)
+def split_normalized(s: str) -> List[str]:
+    """Split a multi-village cell that has already been through norm_text."""
     if not s:
         return []
-    parts = re.split(r"[\n,;/]+", s)
+    parts = s.translate(_SEP_TRANS).split("\n")
     return [p.strip() for p in parts if p.strip()]
 
 
-def detect_map(df: pd.DataFrame) -> Optional[Dict[str, str]]:
-    colnames = [str(c) for c in df.columns]
-    lower = {c: norm_text(c).lower() for c in colnames}
-
-    out: Dict[str, str] = {}
-    for key, opts in ALIASES.items():
-        opts_norm = [norm_text(o).lower() for o in opts]
-        found = None
-
-        for c in colnames:  # exact
-            if lower[c] in opts_norm:
-                found = c
-                break
-
-        if not found:  # substring
-            for c in colnames:
-                for o in opts_norm:
-                    if o and o in lower[c]:
-                        found = c
-                        break
-                if found:
-                    break
-
-        if found:
-            out[key] = found
-
-    needed = {"county", "township", "village"}
-    return out if needed.issubset(out.keys()) else None
-
-
 def forward_fill(df: pd.DataFrame, colmap: Dict[str, str]) -> pd.DataFrame:
     # merged cells -> NaN on following rows
-    for k in ["language", "dialect", "county", "township", "village"]:
-        c = colmap.get(k)
-        if c and c in df.columns:
-            df[c] = df[c].ffill()
+    keys = ["language", "dialect", "county", "township", "village"]
+    cols = [colmap[k] for k in keys if k in colmap and colmap[k] in df.columns]
+    # one multi-column ffill; dedupe in case two keys map to the same column
+    cols = list(dict.fromkeys(cols))
+    if cols:
+        df[cols] = df[cols].ffill()
     return df
 
 
 def iter_xlsx_files(folder: Path) -> List[Path]:
-    return sorted([p for p in folder.rglob("*.xlsx") if not p.name.startswith("~$")])
-
-
-def read_first_sheet(path: Path) -> Tuple[pd.DataFrame, str]:
-    xls = pd.ExcelFile(path)
-    sheet = xls.sheet_names[0]
-    df = pd.read_excel(path, sheet_name=sheet).dropna(axis=1, how="all")
-    return df, sheet
+    return sorted(p for p in folder.rglob("*.xlsx") if not p.name.startswith("~$"))
 
 
 def build_tree_and_dupes(df: pd.DataFrame, colmap: Dict[str, str]):
@@ -126,19 +77,20 @@ def build_tree_and_dupes(df: pd.DataFrame, colmap: Dict[str, str]):
     triple_ct = Counter() # (county, township, village)
     fullrow_ct = Counter()# (lang, dialect, county, township, village)
 
-    for _, row in df.iterrows():
-        county = norm_text(row.get(c_col))
-        town = norm_text(row.get(t_col))
+    # normalize each column once into a plain array; optional columns read as blank
+    counties = vector_norm(df[c_col], NAME_NORMALIZATION).to_numpy()
+    towns = vector_norm(df[t_col], NAME_NORMALIZATION).to_numpy()
+    villages_col = vector_norm(df[v_col], NAME_NORMALIZATION).to_numpy()
+    langs = vector_norm(df[l_col], NAME_NORMALIZATION).to_numpy() if l_col else repeat("")
+    dias = vector_norm(df[d_col], NAME_NORMALIZATION).to_numpy() if d_col else repeat("")
+
+    for county, town, villages_raw, lang, dia in zip(counties, towns, villages_col, langs, dias):
         if not (county and town):
             continue
 
         pair_ct[(county, town)] += 1
 
-        villages_raw = norm_text(row.get(v_col))
-        villages = split_multi(villages_raw) or ([] if not villages_raw else [villages_raw])
-
-        lang = norm_text(row.get(l_col)) if l_col else ""
-        dia = norm_text(row.get(d_col)) if d_col else ""
+        villages = split_normalized(villages_raw) or ([] if not villages_raw else [villages_raw])
 
         for v in villages:
             if not v:
@@ -205,6 +157,27 @@ def write_duplicates_csv(
                 w.writerow(["dup_full_row", n, c, t, v, lang, dia])
 
 
+def process_one(xlsx: Path, out_dir: Path) -> List[str]:
+    """Build the tree and duplicates report for one workbook. Returns the log
+    lines instead of printing them, so main() can report in file order."""
+    df, sheet = read_first_sheet(xlsx)
+    colmap = detect_map(df, DETECT_NEEDED, NAME_NORMALIZATION)
+    if not colmap:
+        return [f"[WARN] {xlsx.name}: missing required columns for (縣,鄉鎮市,村里). Columns={list(df.columns)}"]
+
+    df = forward_fill(df, colmap)
+
+    tree, pair_ct, triple_ct, fullrow_ct = build_tree_and_dupes(df, colmap)
+
+    md_path = out_dir / f"{xlsx.stem}.admin_tree.md"
+    dup_path = out_dir / f"{xlsx.stem}.duplicates.csv"
+
+    write_tree_md(tree, md_path)
+    write_duplicates_csv(pair_ct, triple_ct, fullrow_ct, dup_path)
+
+    return [f"[OK] wrote: {md_path.resolve()}", f"[OK] wrote: {dup_path.resolve()}"]
+
+
 def main():
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -213,28 +186,34 @@ def main():
     print(f"OUTPUT_DIR: {OUTPUT_DIR.resolve()}")
     print(f"Found {len(files)} xlsx file(s).")
 
-    for xlsx in files:
-        df, sheet = read_first_sheet(xlsx)
-        colmap = detect_map(df)
-        if not colmap:
-            print(f"[WARN] {xlsx.name}: missing required columns for (縣,鄉鎮市,村里). Columns={list(df.columns)}")
-            continue
-
-        df = forward_fill(df, colmap)
-
-        tree, pair_ct, triple_ct, fullrow_ct = build_tree_and_dupes(df, colmap)
-
-        md_path = OUTPUT_DIR / f"{xlsx.stem}.admin_tree.md"
-        dup_path = OUTPUT_DIR / f"{xlsx.stem}.duplicates.csv"
-
-        write_tree_md(tree, md_path)
-        write_duplicates_csv(pair_ct, triple_ct, fullrow_ct, dup_path)
-
-        print(f"[OK] wrote: {md_path.resolve()}")
-        print(f"[OK] wrote: {dup_path.resolve()}")
+    # one entry per file: its log lines, or the exception it raised
+    results: List[object] = []
+    if len(files) <= 1:
+        # not worth spinning up worker processes for a single workbook
+        for xlsx in files:
+            try:
+                results.append(process_one(xlsx, OUTPUT_DIR))
+            except Exception as e:
+                results.append(e)
+    else:
+        # outputs are named per workbook, so files can be processed independently
+        with ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as ex:
+            futures = [ex.submit(process_one, xlsx, OUTPUT_DIR) for xlsx in files]
+            results = [fut.exception() or fut.result() for fut in futures]
+
+    failed = False
+    for xlsx, res in zip(files, results):
+        if isinstance(res, Exception):
+            failed = True
+            print(f"[FAIL] {xlsx.name}\n  Reason: {res}")
+        else:
+            print("\n".join(res))
 
     print("\nDone.")
+    # a bad workbook must fail the run, so scripted callers notice
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
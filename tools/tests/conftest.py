@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the scripts live in tools/ and are run directly, not installed as a package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+import convert_xlsx_to_json as conv
+
+
+def _record(lang, dia, county="花蓮縣", township="吉安鄉", villages=("南華村",)):
+    return {"族語": lang, "方言別": dia, "縣": county, "鄉鎮市": township, "村里": list(villages)}
+
+
+def test_per_dialect_counts_each_pair():
+    built = conv.build_all([_record("阿美語", "南勢"), _record("阿美語", "海岸", villages=("港口村", "靜浦村"))])
+    per_dialect = built["admin_stats"]["perDialect"]
+    assert list(per_dialect) == ["阿美語|南勢", "阿美語|海岸"]
+    assert per_dialect["阿美語|海岸"] == {"族語": "阿美語", "方言別": "海岸", "縣_count": 1, "鄉鎮市_count": 1, "村里_count": 2}
+
+
+def test_per_dialect_key_collision_raises():
+    # ("a|b", "c") and ("a", "b|c") both join to "a|b|c"
+    with pytest.raises(ValueError, match="a\\|b\\|c"):
+        conv.build_all([_record("a|b", "c"), _record("a", "b|c")])
+
+
+def test_blank_name_cells_become_empty_strings():
+    # leading cells of a merged block have nothing to forward-fill from
+    df = pd.DataFrame({
+        "族語": [None, None, "阿美語"],
+        "方言別": [None, float("nan"), "南勢"],
+        "縣": [None, "臺東縣", "花蓮縣"],
+        "鄉鎮市": [None, "臺東市", "吉安鄉"],
+        "村里": [None, None, "南華村"],
+    })
+    colmap = conv.detect_map(df, conv.DETECT_NEEDED, conv.NAME_NORMALIZATION)
+    records, _, _ = conv.df_to_records(conv.forward_fill_merged_cells(df, colmap), colmap)
+    # the all-blank row is skipped; blanks read as "" rather than "nan" / "None"
+    assert records == [
+        {"族語": "", "方言別": "", "縣": "臺東縣", "鄉鎮市": "臺東市", "村里": []},
+        {"族語": "阿美語", "方言別": "南勢", "縣": "花蓮縣", "鄉鎮市": "吉安鄉", "村里": ["南華村"]},
+    ]
+
+
+def test_name_columns_only_get_whitespace_cleanup():
+    df = pd.DataFrame({
+        "族語": [" 卡那卡那 富語 "],
+        "方言別": ["南勢（北部）"],
+        "縣": ["台東縣"],
+        "鄉鎮市": ["台東市"],
+    })
+    colmap = conv.detect_map(df, conv.DETECT_NEEDED, conv.NAME_NORMALIZATION)
+    records, _, _ = conv.df_to_records(df, colmap)
+    # only the county goes through NAME_NORMALIZATION
+    assert records == [{"族語": "卡那卡那富語", "方言別": "南勢（北部）", "縣": "臺東縣", "鄉鎮市": "台東市"}]
@@ -0,0 +1,140 @@
+"""Helpers shared by convert_xlsx_to_json.py and make_admin_tree_and_duplicates.py:
+reading the source sheet, normalizing text and mapping columns by alias."""
+import re
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import pandas as pd
+
+try:
+    import python_calamine  # noqa: F401  optional: much faster XLSX reader
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+# Minimal alias map (tweak once, then forget)
+ALIASES = {
+    "language": ["族語", "語言", "Language"],
+    "dialect": ["方言別", "方言", "Dialect"],
+    "county": ["縣市", "縣", "市", "County"],
+    "township": ["鄉鎮市區", "鄉鎮市", "鄉鎮", "Township"],
+    "village": ["村里", "部落", "Village"],
+}
+
+_PAT_WS = re.compile(r"\s+")
+# ideographic space, full-width brackets and separators, applied in one pass
+_NORM_TRANS = str.maketrans({"\u3000": " ", "（": "(", "）": ")", "；": ";", "，": ","})
+
+
+def is_blank(x) -> bool:
+    if x is None:
+        return True
+    if isinstance(x, float) and pd.isna(x):
+        return True
+    s = str(x).strip()
+    return s == "" or s.lower() == "nan"
+
+
+def norm_text(x, names: Optional[Dict[str, str]] = None) -> str:
+    """Unify spaces and brackets, then map the result through the names table if given."""
+    if is_blank(x):
+        return ""
+    s = str(x).translate(_NORM_TRANS)
+    s = _PAT_WS.sub(" ", s).strip()
+    return names.get(s, s) if names else s
+
+
+def vector_norm(series: pd.Series, names: Optional[Dict[str, str]] = None) -> pd.Series:
+    """Column-wise equivalent of norm_text: the same cleanup runs as a few
+    vectorized pandas string passes instead of once per cell. Blank cells become ""."""
+    s = series.astype("string").str.translate(_NORM_TRANS)
+    s = s.str.replace(_PAT_WS, " ", regex=True).str.strip()
+    if names:
+        s = s.replace(names)
+    return s.mask(s.str.lower() == "nan", "").fillna("").astype(object)
+
+
+def open_workbook(path: Path) -> pd.ExcelFile:
+    # pandas' own openpyxl default already reads in read-only, values-only mode
+    reader = {"engine": "calamine"} if HAS_CALAMINE else {}
+    return pd.ExcelFile(path, **reader)
+
+
+def read_first_sheet(path: Path) -> Tuple[pd.DataFrame, str]:
+    # parse through the same handle used to list sheets, so the archive is opened once
+    with open_workbook(path) as xls:
+        sheet = xls.sheet_names[0]
+        df = xls.parse(sheet).dropna(axis=1, how="all")
+    return df, sheet
+
+
+def read_first_sheet_mapped(
+    path: Path,
+    map_columns: Callable[[pd.DataFrame], Optional[Dict[str, str]]],
+) -> Tuple[pd.DataFrame, str, Optional[Dict[str, str]]]:
+    """read_first_sheet followed by map_columns(df), but the mapping is taken
+    from the header row and only the mapped columns are parsed.
+
+    Falls back to the full read_first_sheet frame when the mapping fails, or
+    when a mapped column is missing or entirely empty (read_first_sheet drops
+    those before mapping, which could change the result).
+    Returns (df, sheet, colmap)."""
+    with open_workbook(path) as xls:
+        sheet = xls.sheet_names[0]
+        header = xls.parse(sheet, nrows=0)
+        colmap = map_columns(header)
+        if colmap:
+            names = [str(c) for c in header.columns]
+            wanted = set(colmap.values())
+            idx = [i for i, c in enumerate(names) if c in wanted]
+            if len(idx) == len(wanted) and {names[i] for i in idx} == wanted:
+                df = xls.parse(sheet, usecols=idx).set_axis([header.columns[i] for i in idx], axis=1)
+                if not df.isna().all().any():
+                    return df, sheet, colmap
+
+        df = xls.parse(sheet).dropna(axis=1, how="all")
+    return df, sheet, map_columns(df)
+
+
+# ALIASES normalized once at import: a flat alias -> keys table lets one pass
+# over the columns do every exact match, and one alternation regex per key
+# does the substring fallback.
+_ALIASES_NORM = {k: tuple(norm_text(o).lower() for o in opts) for k, opts in ALIASES.items()}
+_ALIAS_LOOKUP = {
+    o: tuple(k for k, opts in _ALIASES_NORM.items() if o in opts)
+    for opts in _ALIASES_NORM.values()
+    for o in opts
+}
+_ALIASES_PAT = {
+    k: re.compile("|".join(re.escape(o) for o in v if o))
+    for k, v in _ALIASES_NORM.items()
+    if any(v)
+}
+
+
+def detect_map(
+    df: pd.DataFrame,
+    needed: Iterable[str],
+    names: Optional[Dict[str, str]] = None,
+) -> Optional[Dict[str, str]]:
+    """Map ALIASES keys to column names, or None if any needed key is missing."""
+    colnames = [str(c) for c in df.columns]
+    lower = {c: norm_text(c, names).lower() for c in colnames}
+
+    found: Dict[str, str] = {}
+    # exact match first (first matching column wins)
+    for c in colnames:
+        for key in _ALIAS_LOOKUP.get(lower[c], ()):
+            found.setdefault(key, c)
+
+    # substring fallback
+    for key, pat in _ALIASES_PAT.items():
+        if key in found:
+            continue
+        for c in colnames:
+            if pat.search(lower[c]):
+                found[key] = c
+                break
+
+    out = {key: found[key] for key in ALIASES if key in found}
+    return out if set(needed).issubset(out.keys()) else None